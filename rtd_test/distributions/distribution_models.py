@@ -1,9 +1,11 @@
+from collections import OrderedDict
+
 import numpy as np
 import theano
 import theano.tensor as T
 import lasagne
 
-from ..utils import tolist
+from ..utils import epsilon, tolist
 from .distribution_samples import (
     DeterministicSample,
     BernoulliSample,
@@ -17,6 +19,17 @@ from .distribution_samples import (
     DirichletSample,
 )
 
+# Each compiled function gets its own random stream. np_sample_given_x uses
+# the seed itself, as symbolic sampling does, and the others use seeds
+# derived from it, so the streams only depend on the seed and the function.
+_COMPILE_STREAM_OFFSETS = {
+    'sample_given_x': 0,
+    'sample_given_x_batch': 1,
+    'log_likelihood_given_x': 2,
+    'fprop': 3,
+    'sample_mean_given_x': 4,
+}
+
 
 class Distribution(object):
     """
@@ -30,27 +43,81 @@ class Distribution(object):
        conditioning variables.
        e.g. if given = [x,y], then the corresponding log-likehood is
             log p(*|x,y)
+
+    dtype : str
+       The dtype of test samples given to the log-likelihood. Defaults to
+       theano.config.floatX. float16 halves the memory traffic, but the
+       log-likelihood of Gaussian or Laplace is less stable in low precision.
+
+    compile_mode : str or theano.compile.Mode
+       The mode used to compile the np_* functions, e.g. 'FAST_COMPILE' to
+       skip most graph optimizations while developing a model. Defaults to
+       theano.config.mode.
     """
 
+    __slots__ = ('distribution', 'mean_network', 'given', 'inputs', 'dtype',
+                 'output', 'compile_mode', 'set_log_likelihood',
+                 '_input_shape', '_output_shape', '_params_cache',
+                 '_seed', '_theano_funcs')
+
     def __init__(self, distribution, mean_network, given, seed=1,
-                 set_log_likelihood=True):
+                 set_log_likelihood=True, dtype=None, compile_mode=None):
         self.distribution = distribution
         self.mean_network = mean_network
         self.given = given
-        self.inputs = [x.input_var for x in given]
+        self.inputs = tuple(x.input_var for x in given)
+        self._input_shape = tuple(x.shape for x in given)
+        self._output_shape = None
+        self._params_cache = None
         _output_shape = self.get_output_shape()
-        self.output = T.TensorType('float32', (False,) * len(_output_shape))()
+        self.dtype = dtype or theano.config.floatX
+        self.output = T.TensorType(self.dtype, (False,) * len(_output_shape))()
+        self.compile_mode = compile_mode
 
         self.set_log_likelihood = set_log_likelihood
         self.set_seed(seed=seed)
 
     def set_seed(self, seed=1):
-        # Need to call set_seed twice to get consistent sampling results
-        self.distribution.set_seed(seed)  # for compiling theano functions
-        self._set_theano_func()
-        self.distribution.set_seed(seed)  # for actual sampling
+        # The theano functions are recompiled with the new seed on next use
+        self._seed = seed
+        self._theano_funcs = {}
+        self.distribution.set_seed(seed)
+
+    def __getstate__(self):
+        # Slotted classes have no __dict__, which protocol 0/1 pickling
+        # needs. The compiled functions are rebuilt on next use. Subclasses
+        # without __slots__ keep their attributes in __dict__.
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name != '_theano_funcs' and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._theano_funcs = {}
 
     def get_params(self):
+        if self._params_cache is None:
+            self._params_cache = self._collect_params()
+        return list(self._params_cache)
+
+    def invalidate_cache(self):
+        """
+        Clear the cached output shape, paramaters and compiled theano
+        functions. Call this after modifying the networks of this
+        distribution.
+        """
+
+        self._output_shape = None
+        self._params_cache = None
+        self._theano_funcs = {}
+        _output_shape = self.get_output_shape()
+        self.output = T.TensorType(self.dtype, (False,) * len(_output_shape))()
+
+    def _collect_params(self):
         params = lasagne.layers.get_all_params(
             self.mean_network, trainable=True)
         return params
@@ -69,16 +136,18 @@ class Distribution(object):
             The output of this distribution.
         """
 
-        try:
-            inputs = dict(zip(self.given, x))
-        except:
-            raise ValueError("The length of 'x' must be same as 'given'")
-
         deterministic = kwargs.pop('deterministic', False)
-        mean = lasagne.layers.get_output(
-            self.mean_network, inputs, deterministic=deterministic)
+        mean = self._get_output(self.mean_network, x, deterministic)
         return mean
 
+    def _get_output(self, layers, x, deterministic):
+        if len(x) != len(self.given):
+            raise ValueError("The length of 'x' must be same as 'given'")
+
+        output = lasagne.layers.get_output(
+            layers, dict(zip(self.given, x)), deterministic=deterministic)
+        return output
+
     def get_input_shape(self):
         """
         Returns
@@ -87,7 +156,7 @@ class Distribution(object):
           This represents the shape of the inputs of this distribution.
         """
 
-        return [x.shape for x in self.given]
+        return self._input_shape
 
     def get_output_shape(self):
         """
@@ -97,7 +166,10 @@ class Distribution(object):
           This represents the shape of the output of this distribution.
         """
 
-        return lasagne.layers.get_output_shape(self.mean_network)
+        if self._output_shape is None:
+            self._output_shape = lasagne.layers.get_output_shape(
+                self.mean_network)
+        return self._output_shape
 
     def sample_given_x(self, x, repeat=1, **kwargs):
         """
@@ -108,19 +180,53 @@ class Distribution(object):
            to 'given'.
 
         repeat : int or thenao variable
+           The number of samples drawn for each input. If deterministic=True,
+           the network is evaluated once per input and only its outputs are
+           repeated. Otherwise the inputs are repeated, so that stochastic
+           layers (e.g. dropout) are sampled independently for each copy.
 
         Returns
         --------
         list
            This contains 'x' and sample ~ p(*|x), such as [x, sample].
         """
-        if repeat != 1:
+        repeat_outputs = repeat != 1 and kwargs.get('deterministic', False)
+        if repeat != 1 and not repeat_outputs:
             x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
 
         # Feedforward the inputs. The output corresponds to the mean of a distribution,
         # or the mean and the variance if executed from DistributionDouble.
-        output = self.fprop(x, **kwargs)
-        return [x, self.distribution.sample(*tolist(output))]
+        output = tolist(self.fprop(x, **kwargs))
+        if repeat_outputs:
+            x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
+            output = [T.extra_ops.repeat(_output, repeat, axis=0)
+                      for _output in output]
+        return [x, self.distribution.sample(*output)]
+
+    def sample_given_x_batch(self, x, n_samples, **kwargs):
+        """
+        Paramaters
+        --------
+        x : list
+           This contains Theano variables, which must to correspond
+           to 'given'.
+
+        n_samples : int or theano variable
+           The number of samples drawn for each input.
+
+        Returns
+        --------
+        list
+           This contains 'x' and samples ~ p(*|x), whose shape is
+           (n_batch, n_samples, ...).
+        """
+
+        _, sample = self.sample_given_x(x, repeat=n_samples, **kwargs)
+        _shape = sample.shape
+        sample = sample.reshape(
+            [_shape[0] // n_samples, n_samples] +
+            [_shape[i] for i in range(1, sample.ndim)])
+        return [x, sample]
 
     def sample_mean_given_x(self, x, *args, **kwargs):
         """
@@ -156,87 +262,188 @@ class Distribution(object):
         output = self.fprop(x, **kwargs)
         return self.distribution.log_likelihood(sample, *tolist(output))
 
-    def _set_theano_func(self):
+    @property
+    def np_fprop(self):
+        return self._get_theano_func('fprop')
+
+    @property
+    def np_sample_mean_given_x(self):
+        return self._get_theano_func('sample_mean_given_x')
+
+    @property
+    def np_sample_given_x(self):
+        return self._get_theano_func('sample_given_x')
+
+    @property
+    def np_sample_given_x_batch(self):
+        return self._get_theano_func('sample_given_x_batch')
+
+    @property
+    def np_log_liklihood_given_x(self):
+        if not self.set_log_likelihood:
+            raise AttributeError("The log-likelihood of this distribution "
+                                 "is not compiled.")
+        return self._get_theano_func('log_likelihood_given_x')
+
+    def _get_theano_func(self, name):
+        # The theano functions are compiled on first use. The compiled
+        # functions are deliberately not pickled to disk: an unpickled
+        # function holds its own copies of the network's shared variables,
+        # so it would not see parameter updates made by training. Theano's
+        # compiledir already caches the generated C modules across runs.
+        if name not in self._theano_funcs:
+            # Compile with the stream of this function to get consistent
+            # sampling results, and keep the stream used for symbolic
+            # sampling as is.
+            srng = self.distribution.srng
+            self.distribution.set_seed(self._compile_seed(name))
+            try:
+                self._theano_funcs[name] = getattr(self, '_compile_' + name)()
+            finally:
+                self.distribution.srng = srng
+        return self._theano_funcs[name]
+
+    def _compile_seed(self, name):
+        offset = _COMPILE_STREAM_OFFSETS[name]
+        if offset == 0:
+            return self._seed
+        return int(np.random.RandomState(self._seed).randint(
+            1, 2 ** 30, size=offset)[-1])
+
+    def _compile_fprop(self):
         x = self.inputs
         samples = self.fprop(x, deterministic=True)
-        self.np_fprop = theano.function(inputs=x,
-                                        outputs=samples,
-                                        on_unused_input='ignore')
-
+        return theano.function(inputs=x,
+                               outputs=samples,
+                               on_unused_input='ignore',
+                               mode=self.compile_mode)
+
+    def _compile_sample_mean_given_x(self):
+        # When fprop has a single output, it is the mean of samples, so the
+        # compiled fprop is shared. Otherwise only the mean is compiled, to
+        # avoid evaluating the other networks on every call.
+        x = self.inputs
+        if len(tolist(self.fprop(x, deterministic=True))) == 1:
+            return self._get_theano_func('fprop')
         samples = self.sample_mean_given_x(x, deterministic=True)
-        self.np_sample_mean_given_x = theano.function(
-            inputs=x, outputs=samples[-1], on_unused_input='ignore')
+        return theano.function(
+            inputs=x, outputs=samples[-1], on_unused_input='ignore',
+            mode=self.compile_mode)
 
+    def _compile_sample_given_x(self):
+        x = self.inputs
         samples = self.sample_given_x(x, deterministic=True)
-        self.np_sample_given_x = theano.function(
-            inputs=x, outputs=samples[-1], on_unused_input='ignore')
+        return theano.function(
+            inputs=x, outputs=samples[-1], on_unused_input='ignore',
+            mode=self.compile_mode)
 
-        if self.set_log_likelihood:
-            sample = self.output
-            samples = self.log_likelihood_given_x([x, sample],
-                                                  deterministic=True)
-            self.np_log_liklihood_given_x = theano.function(
-                inputs=x + [sample], outputs=samples,
-                on_unused_input='ignore')
+    def _compile_sample_given_x_batch(self):
+        x = self.inputs
+        n_samples = T.iscalar('n_samples')
+        samples = self.sample_given_x_batch(x, n_samples, deterministic=True)
+        return theano.function(
+            inputs=list(x) + [n_samples], outputs=samples[-1],
+            on_unused_input='ignore', mode=self.compile_mode)
+
+    def _compile_log_likelihood_given_x(self):
+        x = self.inputs
+        sample = self.output
+        samples = self.log_likelihood_given_x([x, sample],
+                                              deterministic=True)
+        return theano.function(
+            inputs=list(x) + [sample], outputs=samples,
+            on_unused_input='ignore', mode=self.compile_mode)
 
 
 class DistributionDouble(Distribution):
 
-    def __init__(self, distribution, mean_network, var_network, given, seed=1):
+    __slots__ = ('var_network',)
+
+    def __init__(self, distribution, mean_network, var_network, given, seed=1,
+                 dtype=None, compile_mode=None):
         self.var_network = var_network
         super(DistributionDouble, self).__init__(
-            distribution, mean_network, given, seed)
+            distribution, mean_network, given, seed, dtype=dtype,
+            compile_mode=compile_mode)
+        self._check_output_shapes()
+
+    def invalidate_cache(self):
+        super(DistributionDouble, self).invalidate_cache()
+        self._check_output_shapes()
+
+    def _check_output_shapes(self):
         if self.get_output_shape() != lasagne.layers.get_output_shape(
                 self.var_network):
             raise ValueError("The output shapes of the two networks"
                              "do not match.")
 
-    def get_params(self):
-        params = super(DistributionDouble, self).get_params()
-        params += self.var_network.get_params(trainable=True)
-        # delete duplicated paramaters
-        params = sorted(set(params), key=params.index)
-        return params
+    def _collect_params(self):
+        params = super(DistributionDouble, self)._collect_params()
+        params += lasagne.layers.get_all_params(
+            self.var_network, trainable=True)
+        # delete duplicated paramaters, keeping their order
+        return list(OrderedDict.fromkeys(params))
 
     def fprop(self, x, deterministic=False):
-        mean = super(DistributionDouble,
-                     self).fprop(x, deterministic=deterministic)
-        inputs = dict(zip(self.given, x))
-        var = lasagne.layers.get_output(
-            self.var_network, inputs, deterministic=deterministic)
+        # Build both outputs in one call so that the layers shared by the
+        # two networks appear only once in the graph.
+        mean, var = self._get_output(
+            [self.mean_network, self.var_network], x, deterministic)
         return mean, var
 
 
 class Deterministic(Distribution):
 
-    def __init__(self, network, given, seed=1):
+    __slots__ = ()
+
+    def __init__(self, network, given, seed=1, compile_mode=None):
         distribution = DeterministicSample()
         super(Deterministic, self).__init__(distribution, network, given, seed=seed,
-                                            set_log_likelihood=False)
+                                            set_log_likelihood=False,
+                                            compile_mode=compile_mode)
 
 
 class Bernoulli(Distribution):
 
-    def __init__(self, mean_network, given, temp=0.1, seed=1):
+    __slots__ = ()
+
+    def __init__(self, mean_network, given, temp=0.1, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = BernoulliSample(temp=temp, seed=seed)
-        super(Bernoulli, self).__init__(distribution, mean_network, given, seed)
+        super(Bernoulli, self).__init__(distribution, mean_network, given, seed,
+                                        dtype=dtype, compile_mode=compile_mode)
 
 
 class Categorical(Distribution):
 
-    def __init__(self, mean_network, given, temp=0.1, n_dim=1, seed=1):
+    __slots__ = ('n_dim', 'k')
+
+    def __init__(self, mean_network, given, temp=0.1, n_dim=1, seed=1,
+                 dtype=None, compile_mode=None):
         distribution = CategoricalSample(temp=temp, seed=seed)
-        self.mean_network = mean_network
         self.n_dim = n_dim
+        super(Categorical, self).__init__(distribution, mean_network, given, seed=seed,
+                                          dtype=dtype, compile_mode=compile_mode)
+        self.k = self.get_output_shape()[-1]
+
+    def invalidate_cache(self):
+        super(Categorical, self).invalidate_cache()
         self.k = self.get_output_shape()[-1]
-        super(Categorical, self).__init__(distribution, mean_network, given, seed=seed)
 
     def sample_given_x(self, x, repeat=1, **kwargs):
-        if repeat != 1:
+        repeat_outputs = repeat != 1 and kwargs.get('deterministic', False)
+        if repeat != 1 and not repeat_outputs:
             x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
 
         # use fprop of super class
         mean = Distribution.fprop(self, x, **kwargs)
+        if repeat_outputs:
+            x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
+            # repeat whole rows of n_dim * k, since the network output may
+            # be laid out as (n_batch * n_dim, k)
+            mean = T.extra_ops.repeat(
+                mean.reshape((-1, self.n_dim * self.k)), repeat,
+                axis=0).reshape((-1, self.k))
         output = self.distribution.sample(mean).reshape((-1, self.n_dim * self.k))
         return [x, output]
 
@@ -248,24 +455,36 @@ class Categorical(Distribution):
 
 class Gaussian(DistributionDouble):
 
-    def __init__(self, mean_network, var_network, given, seed=1):
+    __slots__ = ()
+
+    def __init__(self, mean_network, var_network, given, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = GaussianSample(seed=seed)
         super(Gaussian, self).__init__(
-            distribution, mean_network, var_network, given, seed)
+            distribution, mean_network, var_network, given, seed, dtype=dtype,
+            compile_mode=compile_mode)
 
 
 class GaussianConstantVar(Distribution):
 
-    def __init__(self, mean_network, given, var=1, seed=1):
+    __slots__ = ()
+
+    def __init__(self, mean_network, given, var=1, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = GaussianConstantVarSample(constant_var=var, seed=seed)
-        super(GaussianConstantVar, self).__init__(distribution, mean_network, given, seed=seed)
+        super(GaussianConstantVar, self).__init__(distribution, mean_network, given, seed=seed,
+                                                  dtype=dtype, compile_mode=compile_mode)
 
 
 class Laplace(DistributionDouble):
 
-    def __init__(self, mean_network, var_network, given, seed=1):
+    __slots__ = ()
+
+    def __init__(self, mean_network, var_network, given, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = LaplaceSample(seed=seed)
-        super(Laplace, self).__init__(distribution, mean_network, var_network, given, seed=seed)
+        super(Laplace, self).__init__(distribution, mean_network, var_network, given, seed=seed,
+                                      dtype=dtype, compile_mode=compile_mode)
 
 
 class Kumaraswamy(DistributionDouble):
@@ -273,11 +492,14 @@ class Kumaraswamy(DistributionDouble):
     [Naelisnick+ 2016] Deep Generative Models with Stick-Breaking Priors
     """
 
+    __slots__ = ('stick_breaking',)
+
     def __init__(self, a_network, b_network,
-                 given, stick_breaking=True, seed=1):
+                 given, stick_breaking=True, seed=1, compile_mode=None):
         distribution = KumaraswamySample(seed=seed)
         self.stick_breaking = stick_breaking
-        super(Kumaraswamy, self).__init__(distribution, a_network, b_network, given, seed=seed)
+        super(Kumaraswamy, self).__init__(distribution, a_network, b_network, given, seed=seed,
+                                          compile_mode=compile_mode)
 
     def sample_given_x(self, x, repeat=1, **kwargs):
         [x, v] = super(Kumaraswamy, self).sample_given_x(x,
@@ -291,62 +513,73 @@ class Kumaraswamy(DistributionDouble):
         raise NotImplementedError
 
     def _stick_breaking_process(self, v):
-        (n_batch, n_dim) = v.shape
-
-        def segment(v, stick_segment, remaining_stick):
-            stick_segment = v * remaining_stick
-            remaining_stick *= (1 - v)
-            return stick_segment, remaining_stick
-
-        stick_segment = T.zeros((n_batch,))
-        remaining_stick = T.ones((n_batch,))
-
-        (stick_segments, remaining_sticks), updates\
-            = theano.scan(fn=segment,
-                          sequences=v.T[:-1],
-                          outputs_info=[stick_segment, remaining_stick])
-
-        return T.concatenate([stick_segments.T,
-                              remaining_sticks[-1, :][:, np.newaxis]],
+        # segment_i = v_i * prod_{j<i}(1 - v_j), and the last segment is the
+        # remaining stick prod_{j<K-1}(1 - v_j).
+        v = v[:, :-1]
+        # The gradient of cumprod divides by its input, so keep 1 - v away
+        # from 0 (v rounds to 1 in float32 for small b).
+        remaining_sticks = T.concatenate(
+            [T.ones_like(v[:, :1]),
+             T.extra_ops.cumprod(T.clip(1 - v, epsilon(), 1), axis=1)],
+            axis=1)
+        stick_segments = v * remaining_sticks[:, :-1]
+        return T.concatenate([stick_segments, remaining_sticks[:, -1:]],
                              axis=1)
 
 
 class Gamma(DistributionDouble):
 
-    def __init__(self, alpha_network, beta_network, given, seed=1):
+    __slots__ = ()
+
+    def __init__(self, alpha_network, beta_network, given, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = GammaSample(seed=seed)
-        super(Gamma, self).__init__(distribution, alpha_network, beta_network, given, seed=seed)
+        super(Gamma, self).__init__(distribution, alpha_network, beta_network, given, seed=seed,
+                                    dtype=dtype, compile_mode=compile_mode)
 
 
 class Beta(DistributionDouble):
 
+    __slots__ = ()
+
     def __init__(self, alpha_network, beta_network, given,
-                 iter_sampling=6, rejection_sampling=True, seed=1):
+                 iter_sampling=6, rejection_sampling=True, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = BetaSample(
             iter_sampling=iter_sampling,
             rejection_sampling=rejection_sampling,
             seed=seed)
-        super(Beta, self).__init__(distribution, alpha_network, beta_network, given, seed=seed)
+        super(Beta, self).__init__(distribution, alpha_network, beta_network, given, seed=seed,
+                                   dtype=dtype, compile_mode=compile_mode)
 
 
 class Dirichlet(Distribution):
 
+    __slots__ = ('k',)
+
     def __init__(self, alpha_network, given, k,
-                 iter_sampling=6, rejection_sampling=True, seed=1):
+                 iter_sampling=6, rejection_sampling=True, seed=1, dtype=None,
+                 compile_mode=None):
         distribution = DirichletSample(k, iter_sampling=iter_sampling,
                                        rejection_sampling=rejection_sampling,
                                        seed=seed)
         self.k = k
-        super(Dirichlet, self).__init__(distribution, alpha_network, given, seed=seed)
+        super(Dirichlet, self).__init__(distribution, alpha_network, given, seed=seed,
+                                        dtype=dtype, compile_mode=compile_mode)
 
     def sample_given_x(self, x, repeat=1, **kwargs):
-        if repeat != 1:
+        repeat_outputs = repeat != 1 and kwargs.get('deterministic', False)
+        if repeat != 1 and not repeat_outputs:
             x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
 
         # use fprop of super class
         mean = Distribution.fprop(self, x, **kwargs)
+        if repeat_outputs:
+            x = [T.extra_ops.repeat(_x, repeat, axis=0) for _x in x]
+            mean = T.extra_ops.repeat(mean, repeat, axis=0)
         _shape = mean.shape
-        mean = mean.reshape((_shape[0], _shape[1] / self.k,
+        mean = mean.reshape((_shape[0], _shape[1] // self.k,
                              self.k))
-        output = self.distribution.sample(mean).reshape(_shape)
+        # DirichletSample.sample flattens the output back to _shape
+        output = self.distribution.sample(mean)
         return [x, output]
@@ -1,6 +1,8 @@
 import math
 import numpy as np
+import theano
 import theano.tensor as T
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 from theano.tensor.shared_randomstreams import RandomStreams
 
 from ..utils import epsilon
@@ -30,10 +32,10 @@ class DistributionSample(object):
     __metaclass__ = ABCMeta
 
     def __init__(self, seed=1, **kwargs):
-        self.srng = RandomStreams(seed)
+        self.srng = random_streams(seed)
 
     def set_seed(self, seed=1):
-        self.srng = RandomStreams(seed)
+        self.srng = random_streams(seed)
 
     @abstractmethod
     def sample(self):
@@ -538,10 +540,10 @@ class DirichletSample(GammaSample):
 
     def log_likelihood(self, samples, alpha):
         samples = samples.reshape((samples.shape[0],
-                                   samples.shape[1] / self.k,
+                                   samples.shape[1] // self.k,
                                    self.k))
         alpha = alpha.reshape((alpha.shape[0],
-                               alpha.shape[1] / self.k,
+                               alpha.shape[1] // self.k,
                                self.k))
         output = 0
         for _k in range(self.k):
@@ -696,6 +698,24 @@ class UnitDirichletSample(DirichletSample):
                      self).log_likelihood(samples, alpha)
 
 
+def random_streams(seed=1):
+    """
+    Returns
+    -------
+    MRG_RandomStreams or RandomStreams
+        MRG_RandomStreams when theano runs on a GPU, so that the random
+        number generation is moved to the device and samples are not copied
+        from the host. Ops without a GPU implementation fall back to the CPU.
+    """
+
+    if theano.config.device.startswith(('gpu', 'cuda')):
+        if seed == 0:
+            raise ValueError("seed must not be 0 when theano runs on a GPU, "
+                             "since MRG_RandomStreams does not accept it.")
+        return MRG_RandomStreams(seed)
+    return RandomStreams(seed)
+
+
 def mean_sum_samples(samples):
     n_dim = samples.ndim
     if n_dim == 4: